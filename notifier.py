@@ -16,15 +16,24 @@
 # limitations under the License.
 
 """ Notifies projects via email about GitHub activities """
+import collections
+import concurrent.futures
+import configparser
+import functools
 import glob
+import io
 import asfpy.pubsub
 import asfpy.messaging
 import asfpy.syslog
 import yaml
 import yaml.parser
+
+try:  # Use the libyaml C loader if available, it is an order of magnitude faster
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
 import os
 import uuid
-import git
 import re
 import time
 import typing
@@ -37,134 +46,304 @@ print = asfpy.syslog.Printer(identity="github-event-notifier")
 CONFIG_FILE = "github-event-notifier.yaml"
 KNOWN_BOTS_FILE = "known-robots.txt"
 SEND_EMAIL = True
-RE_PROJECT = re.compile(r"(?:incubator-)?([^-]+)")
 RE_JIRA_TICKET = re.compile(r"\b([A-Z0-9]+-\d+)\b")
 DEFAULT_DIFF_WAIT = 10
+REPO_INDEX_INTERVAL = 300  # Rebuild the repository index every five minutes
+REPO_INDEX_MISS_INTERVAL = 60  # ...or on a lookup miss, at most once a minute
 DEBUG = False
-DIFF_COMMENT_BLURB = """
-##########
-%(filename)s:
-##########
-%(diff)s
-
-Review Comment:
-%(text)s
-"""
+# Rewrites some unintuitively named github actions to more human friendly ones for custom subjects
+ACTION_MAP = {
+    "created_issue": "comment_issue",
+    "created_pr": "comment_pr",
+    "diffcomment_collated_pr": "diffcomment",
+    "open_issue": "new_issue",
+    "open_pr": "new_pr",
+}
+# Actions that count as a comment on a ticket vs. a ticket status change
+COMMENT_ACTIONS = frozenset({"comment", "diffcomment", "diffcomment_collated", "edited", "deleted", "created"})
+STATUS_ACTIONS = frozenset({"open", "close", "merge"})
+# Order of preference for scheme lookups (most specific -> least specific), compiled to
+# f-string callables so the format strings aren't re-parsed on every event.
+# Special rules that are only valid for bots like dependabot
+RULES_BOTS = (
+    lambda it, cat, uid: f"{it}_{cat}_bot_{uid}",  # e.g. pullrequests_comment_bot_dependabot
+    lambda it, cat, uid: f"{it}_bot_{uid}",  # e.g. pullrequests_bot_dependabot
+)
+# Human rule keys (also checked for bots with no bot-specific rules), precomputed per
+# (issue type, event category) since that space is tiny and fixed, e.g.
+# ("pullrequests", "comment") -> ("pullrequests_comment", "pullrequests")
+RULES_HUMANS = {
+    (it, cat): (f"{it}_{cat}", it)
+    for it in ("issues", "pullrequests")
+    for cat in ("comment", "status", "unknown")
+}
 JIRA_CREDENTIALS = "/x1/jirauser.txt"
-JIRA_AUTH = tuple(open(JIRA_CREDENTIALS).read().strip().split(":", 1))
+with open(JIRA_CREDENTIALS) as _jira_creds:
+    JIRA_AUTH = tuple(_jira_creds.read().strip().split(":", 1))
 JIRA_HEADERS = {
     "Content-type": "application/json",
     "Accept": "*/*",
 }
 
-def is_bot(userid: str):
-    """Figures out if a GitHub user is a known bot or not"""
+RE_PLACEHOLDER = re.compile(r"%\((\w+)\)s")
+
+
+def diff_comment_blurb(filename, diff, text):
+    """Formats a single review comment for the collated diff mail"""
+    return f"""
+##########
+{filename}:
+##########
+{diff}
+
+Review Comment:
+{text}
+"""
+
+
+def _compile_template(text: str):
+    """Compiles a %(name)s template into a render callable. The template string is
+    split into segments once at load time, so rendering is just a join."""
+    parts = RE_PLACEHOLDER.split(text)  # Alternating literal, field name, literal, ...
+
+    def render(ctx):
+        out = parts[:]
+        out[1::2] = [str(ctx[name]) for name in parts[1::2]]
+        return "".join(out)
+
+    return render
+
+
+def _read_git_ini(cfg_path: str):
+    """Reads the few options we care about from a bare repo's git config file.
+    Git quotes subsection names in section headers, e.g. [hooks \"asfgit\"]."""
+    cp = configparser.RawConfigParser(strict=False)
+    cp.read(cfg_path)
+    return {
+        "commits": cp.get('hooks "asfgit"', "recips", fallback=None),
+        "dev": cp.get("apache", "dev", fallback=None),
+        "jira": cp.get("apache", "jira", fallback=None),
+    }
+
+
+def _load_yaml(path: str):
+    """Loads a YAML file with the fastest available safe loader"""
+    # Binary mode lets the C loader handle the decoding itself
+    with open(path, "rb") as f:
+        return yaml.load(f, Loader=_YamlLoader)
+
+
+@functools.lru_cache(maxsize=512)
+def _default_recipient(project: str):
+    """Fallback recipient address for a project; cached since project cardinality is tiny"""
+    return f"dev@{project}.apache.org"
+
+
+_BOTS_CACHE = {"mtime": 0, "set": frozenset()}
+
+
+@functools.lru_cache(maxsize=4096)
+def _is_known_bot(userid: str):
     if "[bot]" in userid:  # Easiest way to detect is the [bot] marker
         return True
-    # Try the bot file?
-    known_robots = set()
-    if os.path.isfile(KNOWN_BOTS_FILE):  # If we have a list file
-        # Grab all lines that aren't comments
-        bots_from_file = [x.strip() for x in open(KNOWN_BOTS_FILE).readlines() if not x.startswith("#")]
-        #Update bot set with all non-empty lines
-        known_robots.update([bot for bot in bots_from_file if bot])
-    return userid in known_robots
+    return userid in _BOTS_CACHE["set"]
+
+
+def is_bot(userid: str):
+    """Figures out if a GitHub user is a known bot or not"""
+    # Reload the bot file if it has changed (or appeared/disappeared) since last time
+    mtime = os.path.isfile(KNOWN_BOTS_FILE) and os.stat(KNOWN_BOTS_FILE).st_mtime or 0
+    if mtime != _BOTS_CACHE["mtime"]:
+        known_robots = set()
+        if mtime:  # If we have a list file
+            # Grab all lines that aren't comments
+            bots_from_file = [x.strip() for x in open(KNOWN_BOTS_FILE).readlines() if not x.startswith("#")]
+            #Update bot set with all non-empty lines
+            known_robots.update([bot for bot in bots_from_file if bot])
+        _BOTS_CACHE["mtime"] = mtime
+        _BOTS_CACHE["set"] = frozenset(known_robots)
+        _is_known_bot.cache_clear()  # Memoized answers may be stale now
+    return _is_known_bot(userid)
 
 
 class DiffComments:
     def __init__(self, uid, original_payload):
         self.created = time.time()
-        self.diffs = []
+        # Comments are collated straight into a string buffer, so flushing doesn't have to
+        # join (and briefly double-hold) a list of blurbs
+        self.buffer = io.StringIO()
+        self.count = 0
         self.payload = original_payload
 
     def add(self, filename, diff, text):
-        difftext = DIFF_COMMENT_BLURB % locals()
-        self.diffs.append(difftext)
+        if self.count:
+            self.buffer.write("\n\n")
+        self.buffer.write(diff_comment_blurb(filename, diff, text))
+        self.count += 1
 
 
 class Notifier:
     def __init__(self, cfg_file: str):
-        self.config = yaml.safe_load(open(cfg_file))
+        self.config = _load_yaml(cfg_file)
+        # Repository allow/deny lists as frozensets, so the per-event membership test is O(1)
+        for filter_key in ("only", "ignore"):
+            if filter_key in self.config:
+                self.config[filter_key] = frozenset(self.config[filter_key])
         self.templates = {}
-        self.diffcomments: typing.Dict[str, DiffComments] = {}
-        for key, tmpl_file in self.config["templates"].items():
-            if os.path.exists(tmpl_file):
-                print("Loading template " + tmpl_file)
-                subject, contents = open(tmpl_file).read().split("\n", 1)
-                subject = subject.replace("subject: ", "")
-                contents = contents.strip()
-                self.templates[key] = (
-                    subject,
-                    contents,
-                )
+        self._template_mtimes: typing.Dict[str, float] = {}
+        self._reload_templates()
+        # Insertion-ordered, so flush() only ever needs to inspect the oldest entries
+        self.diffcomments: typing.Dict[str, DiffComments] = collections.OrderedDict()
+        # Merged scheme cache, keyed by repo path: (scheme mtime, git config mtime, merged scheme dict)
+        self._scheme_cache: typing.Dict[str, tuple] = {}
+        # Repository name -> path index, so we don't glob the entire repo tree on every event
+        self._repo_index: typing.Dict[str, str] = {}
+        self._repo_index_ts = 0.0
+        self._build_repo_index()
+        # Per-repo github settings cache for custom subjects: (mtime, parsed yaml or None)
+        self._subject_cache: typing.Dict[str, tuple] = {}
+        # Worker pool for outgoing email, so SMTP latency doesn't block the event loop
+        self._mail_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="mail")
+        # Cap on concurrent JIRA updates, so we don't overwhelm the JIRA server
+        self._jira_semaphore = asyncio.Semaphore(8)
+        # Persistent JIRA session - reuses connections instead of a TLS handshake per REST call
+        self._jira = requests.Session()
+        self._jira.headers.update(JIRA_HEADERS)
+        self._jira.auth = JIRA_AUTH
+        self._jira.mount(
+            "https://",
+            requests.adapters.HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=16,
+                max_retries=requests.adapters.Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+            ),
+        )
 
     def get_custom_subject(self, repository, action="catchall"):
         """Gets a subject template for a specific action, if specified via .asf.yaml"""
-        # Rewrite some unintuitively named github actions to more human friendly ones.
-        action_map = {
-            "created_issue": "comment_issue",
-            "created_pr": "comment_pr",
-            "diffcomment_collated_pr": "diffcomment",
-            "open_issue": "new_issue",
-            "open_pr": "new_pr",
-        }
-        if action in action_map:
-            action = action_map[action]
+        if action in ACTION_MAP:
+            action = ACTION_MAP[action]
 
         ymlfile = f"/x1/asfyaml/ghsettings.{repository}.yml"  # Path to github settings yaml file
-        if os.path.isfile(ymlfile):
+        try:
+            mtime = os.stat(ymlfile).st_mtime
+        except OSError:  # No github settings file, no custom subjects
+            return
+        cached = self._subject_cache.get(repository)
+        if cached and cached[0] == mtime:
+            yml = cached[1]
+        else:
             try:
-                yml = yaml.safe_load(open(ymlfile))
+                yml = _load_yaml(ymlfile)
             except yaml.parser.ParserError:  # Invalid YAML?!
-                return
-            custom_subjects = yml.get("custom_subjects")
-            if custom_subjects and isinstance(custom_subjects, dict):
-                if action in custom_subjects:
-                    return custom_subjects[action]
-                elif "catchall" in custom_subjects:  # If no custom subject exists for this action, but catchall does...
-                    return custom_subjects["catchall"]
-
-    def get_recipient(self, repository, itype, action="comment", userid=None):
-        m = RE_PROJECT.match(repository)
-        if m:
-            project = m.group(1)
-        else:
-            project = "infra"
-        repo_path = None
-        scheme = {}
+                yml = None
+            self._subject_cache[repository] = (mtime, yml)
+        if not yml:
+            return
+        custom_subjects = yml.get("custom_subjects")
+        if custom_subjects and isinstance(custom_subjects, dict):
+            if action in custom_subjects:
+                return custom_subjects[action]
+            elif "catchall" in custom_subjects:  # If no custom subject exists for this action, but catchall does...
+                return custom_subjects["catchall"]
+
+    def _reload_templates(self):
+        """Loads mail templates, re-reading only those that changed on disk since last time.
+        Called at startup and periodically from flush(), so template edits are picked up
+        without a restart."""
+        for key, tmpl_file in self.config["templates"].items():
+            try:
+                mtime = os.stat(tmpl_file).st_mtime
+            except OSError:  # No such template file
+                continue
+            if self._template_mtimes.get(key) == mtime:
+                continue
+            print("Loading template " + tmpl_file)
+            with open(tmpl_file, "r", encoding="utf-8") as f:
+                subject = f.readline().rstrip("\n").removeprefix("subject: ")
+                contents = f.read().strip()
+            self.templates[key] = (
+                _compile_template(subject),
+                _compile_template(contents),
+            )
+            self._template_mtimes[key] = mtime
+
+    def _build_repo_index(self):
+        """Scans the configured repository paths and indexes repositories by their directory name"""
+        index = {}
         for root_dir in self.config["repository_paths"]:
-            for path in glob.glob(root_dir):
-                if os.path.basename(path) == f"{repository}.git":
-                    repo_path = path
-                    break
-        if repo_path:
-            scheme_path = os.path.join(repo_path, self.config["scheme_file"])
-            if os.path.exists(scheme_path):
+            parent, leaf = os.path.split(root_dir)
+            # Plain "<dir>/*<suffix>" patterns can use scandir directly, skipping the fnmatch engine
+            if not glob.has_magic(parent) and leaf.startswith("*") and not glob.has_magic(leaf[1:]):
+                suffix = leaf[1:]
                 try:
-                    scheme = yaml.safe_load(open(scheme_path))
-                except Exception: # TODO: narrow further to expected Exceptions
+                    with os.scandir(parent) as entries:
+                        for entry in entries:
+                            if entry.name.endswith(suffix):
+                                index[entry.name] = entry.path
+                except OSError:  # Parent directory missing, nothing to index
                     pass
+            else:  # Anything fancier goes through glob as before
+                for path in glob.iglob(root_dir):
+                    index[os.path.basename(path)] = path
+        self._repo_index = index
+        self._repo_index_ts = time.time()
+
+    def _load_repo_scheme(self, repo_path):
+        """Loads the notification scheme for a repository, with defaults woven in from its git config.
+        The merged scheme is cached per repo and only re-read when either file changes on disk."""
+        scheme_path = os.path.join(repo_path, self.config["scheme_file"])
+        cfg_path = os.path.join(repo_path, "config")
+        try:
+            scheme_mtime = os.stat(scheme_path).st_mtime
+        except OSError:  # No scheme file in this repo
+            scheme_mtime = 0
+        try:
+            cfg_mtime = os.stat(cfg_path).st_mtime
+        except OSError:
+            cfg_mtime = 0
+        cached = self._scheme_cache.get(repo_path)
+        if cached and cached[0] == scheme_mtime and cached[1] == cfg_mtime:  # Nothing changed, reuse
+            return cached[2]
+        scheme = {}
+        if scheme_mtime:
+            try:
+                scheme = _load_yaml(scheme_path)
+            except Exception: # TODO: narrow further to expected Exceptions
+                pass
+
+        # Check standard git config
+        cfg = _read_git_ini(cfg_path)
+
+        # If the yaml scheme is missing parts, weave in the defaults from the git config in their place
+        # Commits mailing list
+        if "commits" not in scheme:
+            scheme["commits"] = cfg["commits"] or self.config["default_recipient"]
+        # Issues and Pull Requests
+        if cfg["dev"] is not None:
+            default_issue = cfg["dev"]
+            if "issues" not in scheme:
+                scheme["issues"] = default_issue
+            if "pullrequests" not in scheme:
+                scheme["pullrequests"] = default_issue
+        # Jira notification options
+        if cfg["jira"] is not None:
+            if "jira_options" not in scheme:
+                scheme["jira_options"] = cfg["jira"]
+        self._scheme_cache[repo_path] = (scheme_mtime, cfg_mtime, scheme)
+        return scheme
 
-            # Check standard git config
-            cfg_path = os.path.join(repo_path, "config")
-            cfg = git.GitConfigParser(cfg_path)
-
-            # If the yaml scheme is missing parts, weave in the defaults from the git config in their place
-            # Commits mailing list
-            if "commits" not in scheme:
-                scheme["commits"] = cfg.get("hooks.asfgit", "recips") or self.config["default_recipient"]
-            # Issues and Pull Requests
-            if cfg.has_option("apache", "dev"):
-                default_issue = cfg.get("apache", "dev")
-                if "issues" not in scheme:
-                    scheme["issues"] = default_issue
-                if "pullrequests" not in scheme:
-                    scheme["pullrequests"] = default_issue
-            # Jira notification options
-            if cfg.has_option("apache", "jira"):
-                default_jira = cfg.get("apache", "jira")
-                if "jira_options" not in scheme:
-                    scheme["jira_options"] = default_jira
+    def get_recipient(self, repository, itype, action="comment", userid=None):
+        # Project name is the bit before the first dash, sans any incubator- prefix
+        project = repository.removeprefix("incubator-").split("-", 1)[0] or "infra"
+        scheme = {}
+        repo_path = self._repo_index.get(f"{repository}.git")
+        if repo_path is None and self._repo_index_ts < time.time() - REPO_INDEX_MISS_INTERVAL:
+            # Could be a newly created repository - refresh the index and retry
+            self._build_repo_index()
+            repo_path = self._repo_index.get(f"{repository}.git")
+        if repo_path:
+            scheme = self._load_repo_scheme(repo_path)
 
         if scheme:
             if itype not in ("commit", "jira") and userid:
@@ -173,41 +352,25 @@ class Notifier:
 
                 # Work out the type of event (ticket status change, or comment)
                 event_category = "unknown"
-                if action in ("comment", "diffcomment", "diffcomment_collated", "edited", "deleted", "created"):
+                if action in COMMENT_ACTIONS:
                     event_category = "comment"
-                elif action in ("open", "close", "merge"):
+                elif action in STATUS_ACTIONS:
                     event_category = "status"
 
-                # Order of preference for scheme (most specific -> least specific)
-                # Special rules that are only valid for bots like dependabot
-                rule_order_bots = (
-                    "{issue_type}_{event_category}_bot_{userid}",  # e.g. pullrequests_comment_bot_dependabot
-                    "{issue_type}_bot_{userid}",  # e.g. pullrequests_bot_dependabot
-                )
-                # Humans (and bots with no bot-specific rules)
-                rule_order_humans = (
-                    "{issue_type}_{event_category}",  # e.g. pullrequests_comment
-                    "{issue_type}",  # e.g. pullrequests
-                )
-
-                rule_dict = {
-                    "issue_type": github_issue_type,
-                    "event_category": event_category,
-                    "userid": userid.replace("[bot]", ""),  # Only bot rules use this, so the bot tag is implied anyway.
-                }
+                uid_clean = userid.replace("[bot]", "")  # Only bot rules use this, so the bot tag is implied anyway.
 
                 # If bot, we remove the [bot] in the user ID and check the bot rules
                 if is_bot(userid):
                     print(f"{userid} is a known bot, expanding rule-set")
-                    for rule in rule_order_bots:
-                        key = rule.format(**rule_dict)
-                        if key in scheme and scheme[key]:  # If we have this scheme and it is non-empty, return it
-                            return scheme[key]
+                    for make_key in RULES_BOTS:
+                        recipient = scheme.get(make_key(github_issue_type, event_category, uid_clean))
+                        if recipient:  # If we have this scheme and it is non-empty, return it
+                            return recipient
                 # Human rules (also applies to bots with no specific rules for them)
-                for rule in rule_order_humans:
-                    key = rule.format(**rule_dict)
-                    if key in scheme and scheme[key]:  # If we have this scheme and it is non-empty, return it
-                        return scheme[key]
+                for key in RULES_HUMANS[(github_issue_type, event_category)]:
+                    recipient = scheme.get(key)
+                    if recipient:  # If we have this scheme and it is non-empty, return it
+                        return recipient
                 # return self.config["default_recipient"]  # No (non-empty) scheme found, return default git recipient
 
             elif itype == "commit" and "commits" in scheme:
@@ -216,35 +379,45 @@ class Notifier:
                 return scheme.get("jira_options", self.config["jira"]["default_options"])
         if itype == "jira":
             return self.config["jira"]["default_options"]
-        return "dev@%s.apache.org" % project
+        return _default_recipient(project)
 
     async def flush(self):
-        to_remove = []
-        for uid, diffcomment in self.diffcomments.items():
-            if diffcomment.created < time.time() - DEFAULT_DIFF_WAIT:
-                print(f"Writing collated diff with {len(diffcomment.diffs)} items...")
-                payload = diffcomment.payload
-                payload["diff"] = "\n\n".join(diffcomment.diffs)
-                payload["action"] = "diffcomment_collated"
-                await self.handle_payload({"payload": payload})
-                to_remove.append(uid)
-        for uid in to_remove:
-            del self.diffcomments[uid]
+        if self._repo_index_ts < time.time() - REPO_INDEX_INTERVAL:
+            self._build_repo_index()
+            self._reload_templates()  # Also pick up edited templates now and then
+        cutoff = time.time() - DEFAULT_DIFF_WAIT
+        # Entries were inserted in creation order, so stop at the first one that isn't old enough
+        while self.diffcomments:
+            diffcomment = next(iter(self.diffcomments.values()))
+            if diffcomment.created >= cutoff:
+                break
+            self.diffcomments.popitem(last=False)
+            print(f"Writing collated diff with {diffcomment.count} items...")
+            payload = diffcomment.payload
+            payload["diff"] = diffcomment.buffer.getvalue()
+            payload["action"] = "diffcomment_collated"
+            await self.handle_payload({"payload": payload})
 
     async def handle_payload(self, raw):
         payload = raw.get("payload")
         if not payload:  # Pong, use this for pushing collated items
             await self.flush()
             return
-        user = payload.get("user")
-        action = payload.get(
-            "action"
-        )  # open = new ticket, created = commented, edited = changed text, close = closed ticket, diffcomment = comment on file
         repository = payload.get("repo")
+        # Filtered repositories are dropped before any further unpacking
         if "only" in self.config and repository not in self.config["only"]:
             return
         if "ignore" in self.config and repository in self.config["ignore"]:
             return
+        user = payload.get("user")
+        action = payload.get(
+            "action"
+        )  # open = new ticket, created = commented, edited = changed text, close = closed ticket, diffcomment = comment on file
+        ptype = payload.get("type", "pullrequest")
+        category = "issue" if ptype == "issue" else "pr"
+        real_action = action + "_" + category
+        if real_action not in self.templates and action != "diffcomment":
+            return  # No mail template for this action, don't bother unpacking the rest
         title = payload.get("title", "")
         text = payload.get("text", "")
         issue_id = payload.get("id", "")
@@ -252,64 +425,116 @@ class Notifier:
         filename = payload.get("filename", "")
         diff = payload.get("diff", "")
         pr_id = issue_id # Github uses the same number pool for PRs and issues
-        category = payload.get("type") == "issue" and "issue" or "pr"
         node_id = payload.get("node_id")  # Used for message references/threading
-        real_action = action + "_" + category
         if action == "diffcomment":
             uid = f"{repository}-{pr_id}-{user}"
             if uid not in self.diffcomments:
                 self.diffcomments[uid] = DiffComments(uid, payload)
             self.diffcomments[uid].add(filename, diff, text)
 
-        ml = self.get_recipient(repository, payload.get("type", "pullrequest"), action, user)
+        if real_action not in self.templates:  # Collated diff comments get mailed later, from flush()
+            return
+
+        ml = self.get_recipient(repository, ptype, action, user)
         print("notifying", ml)
         ml_list, ml_domain = ml.split("@", 1)
-        if real_action in self.templates:
-            # Note: the subjects are checked for validity in
-            # https://github.com/apache/infrastructure-p6/blob/production/modules/gitbox/files/asfgit/package/asfyaml.py
-            # See VALID_GITHUB_SUBJECT_VARIABLES and validate_github_subject()
-            # The variable names listed in VALID_GITHUB_SUBJECT_VARIABLES must be defined
-            # here as local variables
-            subject_line = self.get_custom_subject(repository, real_action)  # Custom subject line?
-            try:
-                if subject_line:
-                    subject_line = subject_line.format(**locals())
-                else:
-                    subject_line = self.templates[real_action][0] % locals()
-                real_text = self.templates[real_action][1] % locals()
-            except (KeyError, ValueError) as e:  # Template breakage can happen, ignore
-                print(e)
-                return
-            msg_headers = {}
-            msgid = "<%s-%s@gitbox.apache.org>" % (node_id, str(uuid.uuid4()))
-            msgid_OP = "<%s@gitbox.apache.org>" % node_id
-            if action == "open" and not payload.get("changes"):  # NB: If payload has a 'changes' element that is not None, it is NOT a new PR!
-                msgid = msgid_OP  # This is the first email, make a deterministic message id
+        # Note: the subjects are checked for validity in
+        # https://github.com/apache/infrastructure-p6/blob/production/modules/gitbox/files/asfgit/package/asfyaml.py
+        # See VALID_GITHUB_SUBJECT_VARIABLES and validate_github_subject()
+        # The variable names listed in VALID_GITHUB_SUBJECT_VARIABLES must be defined
+        # here as keys in the template context
+        ctx = {
+            "user": user,
+            "action": action,
+            "repository": repository,
+            "title": title,
+            "text": text,
+            "issue_id": issue_id,
+            "link": link,
+            "filename": filename,
+            "diff": diff,
+            "pr_id": pr_id,
+            "category": category,
+            "ml_list": ml_list,
+            "ml_domain": ml_domain,
+        }
+        subject_line = self.get_custom_subject(repository, real_action)  # Custom subject line?
+        try:
+            if subject_line:
+                subject_line = subject_line.format(**ctx)
             else:
-                msg_headers = {"In-Reply-To": msgid_OP}  # Thread from the first PR/issue email
-            print(subject_line)
-            # print(msgid)
-            # print(msg_headers)
-            if SEND_EMAIL:
-                recipient = ml
-                asfpy.messaging.mail(
+                subject_line = self.templates[real_action][0](ctx)
+            real_text = self.templates[real_action][1](ctx)
+        except (KeyError, ValueError) as e:  # Template breakage can happen, ignore
+            print(e)
+            return
+        msgid_OP = f"<{node_id}@gitbox.apache.org>"
+        if action == "open" and not payload.get("changes"):  # NB: If payload has a 'changes' element that is not None, it is NOT a new PR!
+            msgid = msgid_OP  # This is the first email, make a deterministic message id
+            msg_headers = {}
+        else:
+            msgid = f"<{node_id}-{uuid.uuid4()}@gitbox.apache.org>"
+            msg_headers = {"In-Reply-To": msgid_OP}  # Thread from the first PR/issue email
+        print(subject_line)
+        # print(msgid)
+        # print(msg_headers)
+        if SEND_EMAIL:
+            recipient = ml
+            asyncio.get_running_loop().run_in_executor(
+                self._mail_pool,
+                functools.partial(
+                    asfpy.messaging.mail,
                     sender=f"\"{user} (via GitHub)\" <git@apache.org>",
                     recipient=recipient,
                     subject=subject_line,
                     message=real_text,
                     messageid=msgid,
                     headers=msg_headers,
-                )
-            jopts = self.get_recipient(repository, "jira")
-            if jopts:
-                jira_text = real_text.split("-- ", 1)[0]
-                self.notify_jira(jopts, pr_id, title, jira_text, link)
+                ),
+            )
+        if not RE_JIRA_TICKET.search(title):  # No ticket in the title means no JIRA update, skip the lookup
+            return
+        jopts = self.get_recipient(repository, "jira")
+        if jopts:
+            jira_text = real_text.split("-- ", 1)[0]
+            # Update JIRA in the background so its round-trips don't stall the listener
+            asyncio.create_task(self._notify_jira_bg(jopts, pr_id, title, jira_text, link))
+
+    async def _notify_jira_bg(self, jopts, prid, prtitle, prmessage, prlink):
+        """Runs notify_jira in a worker thread, off the event loop"""
+        async with self._jira_semaphore:
+            await asyncio.to_thread(self.notify_jira, jopts, prid, prtitle, prmessage, prlink)
+
+    async def _flush_timer(self):
+        """Flushes collated diff comments on a fixed schedule, so a quiet or busy pubsub
+        connection cannot delay collation past the wait window"""
+        while True:
+            await asyncio.sleep(DEFAULT_DIFF_WAIT / 2)
+            await self.flush()
 
     async def listen(self):
-        async for payload in asfpy.pubsub.listen(
-            self.config["pubsub_url"], self.config.get("pubsub_user"), self.config.get("pubsub_pass")
-        ):
-            await self.handle_payload(payload)
+        sem = asyncio.Semaphore(16)  # Cap on payloads processed concurrently
+        pending = set()
+        flusher = asyncio.create_task(self._flush_timer())
+
+        async def process(raw):
+            async with sem:
+                await self.handle_payload(raw)
+
+        try:
+            async for payload in asfpy.pubsub.listen(
+                self.config["pubsub_url"], self.config.get("pubsub_user"), self.config.get("pubsub_pass")
+            ):
+                # Process payloads as tasks, so one slow payload (JIRA/SMTP) doesn't hold up the rest.
+                # Tasks start in arrival order, and diff comments are collated before the first await,
+                # so collation order is preserved.
+                task = asyncio.create_task(process(payload))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            flusher.cancel()
+            if pending:  # Drain in-flight payloads before shutting down
+                await asyncio.gather(*pending, return_exceptions=True)
 
     def jira_update_ticket(self, ticket, txt, worklog=False):
         """Post JIRA comment or worklog entry"""
@@ -319,10 +544,8 @@ class Notifier:
             where = "worklog"
             data = {"timeSpent": "10m", "comment": txt}
 
-        rv = requests.post(
+        rv = self._jira.post(
             "https://issues.apache.org/jira/rest/api/latest/issue/%s/%s" % (ticket, where),
-            headers=JIRA_HEADERS,
-            auth=JIRA_AUTH,
             json=data,
         )
         if rv.status_code == 200 or rv.status_code == 201:
@@ -341,10 +564,8 @@ class Notifier:
                 "icon": {"url16x16": "https://github.com/favicon.ico"},
             },
         }
-        rv = requests.post(
+        rv = self._jira.post(
             "https://issues.apache.org/jira/rest/api/latest/issue/%s/remotelink" % ticket,
-            headers=JIRA_HEADERS,
-            auth=JIRA_AUTH,
             json=data,
         )
         if rv.status_code == 200 or rv.status_code == 201:
@@ -355,10 +576,8 @@ class Notifier:
     def jira_add_label(self, ticket):
         """Add a "PR available" label to JIRA"""
         data = {"update": {"labels": [{"add": "pull-request-available"}]}}
-        rv = requests.put(
+        rv = self._jira.put(
             "https://issues.apache.org/jira/rest/api/latest/issue/%s" % ticket,
-            headers=JIRA_HEADERS,
-            auth=JIRA_AUTH,
             json=data,
         )
         if rv.status_code == 200 or rv.status_code == 201: